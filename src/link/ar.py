@@ -1,5 +1,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 from collections import namedtuple
+from collections.abc import Mapping
+import mmap
+import os
+import struct
+import sys
 
 from . import parse
 
@@ -9,9 +14,150 @@ from . import parse
 # (3) https://web.archive.org/web/20070624034732/https://www.microsoft.com/msj/0498/hood0498.aspx
 # (3.1) https://web.archive.org/web/20100629163054/http://www.microsoft.com/msj/0498/hoodtextfigs.htm
 
+# The fixed-layout header that precedes each member. Field widths are from source (1).
+_MEMBER_HEADER = struct.Struct("16s12s6s6s8s10s2s")
+# The file starts with the magic number, which is immediately followed by the first member's header.
+_MAGIC_AND_MEMBER_HEADER = struct.Struct("8s" + _MEMBER_HEADER.format)
+
 class ArchiveReadException(Exception):
   pass
 
+def _map_file(path):
+  with open(path, "rb") as f:
+    # `mmap` refuses to map empty files. There's nothing to map anyways, so just let `load` fail
+    # on the empty buffer.
+    if os.fstat(f.fileno()).st_size == 0:
+      return b""
+    # The mapping remains valid after the file is closed and lives as long as something references
+    # it.
+    return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+# Member filenames come in a few formats, described by the "Windows variant" section of source (1).
+# Each member's filename is classified and then handed to the matching `_FILENAME_PARSERS` entry,
+# which returns the actual filename.
+# The special "/" and "//" members. These are left as-is.
+_FILENAME_SPECIAL = 0
+# A `/` marks the end of the filename.
+_FILENAME_TERMINATED = 1
+# The filename begins with a `/` and is followed by an ASCII numeric offset into the filename
+# lookup member that is used to lookup the null terminated filename.
+_FILENAME_LOOKUP = 2
+_FILENAME_INVALID = 3
+
+def _classify_filename(filename):
+  if filename.endswith("/"):
+    if filename in ("/", "//"):
+      return _FILENAME_SPECIAL
+    return _FILENAME_TERMINATED
+  if filename.startswith("/"):
+    return _FILENAME_LOOKUP
+  return _FILENAME_INVALID
+
+def _parse_special_filename(filename, filename_member):
+  return filename
+
+def _parse_terminated_filename(filename, filename_member):
+  return filename[:-1]
+
+def _parse_lookup_filename(filename, filename_member):
+  filename_offset = int(filename[1:])
+  if filename_member is None:
+    raise ArchiveReadException(
+      f"Member's filename ({filename}) references nonexistent filename lookup member"
+    )
+  return filename_member.content.read_cstring(seek = filename_offset)
+
+def _parse_invalid_filename(filename, filename_member):
+  raise ArchiveReadException(f"Filename has unexpected format: \"{filename}\"")
+
+_FILENAME_PARSERS = (
+  _parse_special_filename,
+  _parse_terminated_filename,
+  _parse_lookup_filename,
+  _parse_invalid_filename,
+)
+
+class _SymbolMemberMap(Mapping):
+  """
+    The `symbol_member_map` of an `ArchiveReader`. Libraries can contain a great many symbols, only
+    a few of which a given caller is likely to look up, so the index member isn't parsed until the
+    first time that this mapping is accessed. Consequently, a malformed index raises
+    `ArchiveReadException` on first access rather than from `ArchiveReader.load`.
+
+    When created without an index, the map is empty.
+  """
+
+  def __init__(self, index_content = None, member_name_by_offset = None):
+    self._index_content = index_content
+    self._member_name_by_offset = member_name_by_offset
+    self._map = {} if index_content is None else None
+
+  def _get_map(self):
+    if self._map is None:
+      # Parse from a clone so that a failed parse doesn't leave the index stream half consumed.
+      self._map = self._parse_index(self._index_content.clone(), self._member_name_by_offset)
+      # Neither of these are needed anymore.
+      self._index_content = None
+      self._member_name_by_offset = None
+    return self._map
+
+  @staticmethod
+  def _parse_index(index_content, member_name_by_offset):
+    # First thing in the index file is the symbol count
+    symbol_count = index_content.read_big_endian_dword()
+
+    # Second thing in the index file is the array of member offsets. Third thing in the index file
+    # is the list of the symbol names that the member at the corresponding offset describes.
+    # Note that the offsets are consecutive `DWORD`s while the symbol names are consecutive C
+    # Strings (i.e. null byte delimited).
+    # Both arrays are decoded in bulk rather than one entry at a time since libraries can easily
+    # contain tens of thousands of symbols.
+    try:
+      member_offsets = index_content.read_struct(struct.Struct(f">{symbol_count}I"))
+    except parse.BufferStreamIndexError:
+      raise ArchiveReadException(
+        f"Index is too short to hold {symbol_count} member offsets"
+      ) from None
+    try:
+      symbol_names = index_content.read_cstrings(symbol_count)
+    except parse.BufferStreamIndexError:
+      raise ArchiveReadException(
+        f"Index has {symbol_count} member offsets but fewer symbol names"
+      ) from None
+
+    # Resolve all the offsets in a single pass. Every offset ought to exactly match the offset of a
+    # member header, so a lookup that fails (rather than, say, a sorted search that finds the
+    # nearest member) is what we want anyways.
+    try:
+      member_names = list(map(member_name_by_offset.__getitem__, member_offsets))
+    except KeyError as e:
+      raise ArchiveReadException(
+        f"Index references nonexistent member at offset {e.args[0]}"
+      ) from None
+
+    symbol_member_map = dict(zip(symbol_names, member_names))
+    # Any symbol that appeared more than once will have collapsed into a single entry.
+    if len(symbol_member_map) != symbol_count:
+      raise ArchiveReadException(
+        "Oop, I guess this library needs to support symbols in multiple members"
+      )
+    return symbol_member_map
+
+  def __getitem__(self, symbol_name):
+    return self._get_map()[symbol_name]
+
+  def __contains__(self, symbol_name):
+    return symbol_name in self._get_map()
+
+  def __iter__(self):
+    return iter(self._get_map())
+
+  def __len__(self):
+    return len(self._get_map())
+
+  def __repr__(self):
+    return repr(self._get_map())
+
 class ArchiveReader:
   """
     This class is designed to pull data out of `.lib` files the would normally be used by a linker
@@ -30,13 +176,24 @@ class ArchiveReader:
 
     Perusing around, it doesn't really seem like these files ever exceed a few megabytes. So, for
     the time being, this class will not support seeking through the file and pulling out the
-    requested bits on demand. We will just load the whole file into memory at once.
-
-    The main interfaces into `ArchiveReader` instances are the `members` and `symbol_member_map`
-    dictionary member values. `symbol_member_map` maps symbol names to member filenames. `members`
-    maps member filenames to instances of `ArchiveReader.Member`, which provides access to the
-    member's data and metadata. Note that the index and filename lookup members are currently not
-    included.
+    requested bits on demand. `read_file` memory maps the whole file and parses it as if it were
+    already in memory, leaving it to the OS to page it in.
+
+    Because of that, the file must not change while the reader is using it. Member `content`
+    streams and the symbol index read straight out of the mapping whenever they are accessed, so if
+    the file is truncated, accessing them may kill the process (ex: with `SIGBUS`). On Windows, the
+    mapping also prevents the file from being overwritten. Call `close` (or use the reader as a
+    context manager) to release the mapping once the reader is no longer needed.
+
+    The main interfaces into `ArchiveReader` instances are the `members` dictionary and the
+    `symbol_member_map` mapping member values. `members` maps member filenames to instances of
+    `ArchiveReader.Member`, which provides access to the member's data and metadata. Note that the
+    index and filename lookup members are currently not included.
+
+    `symbol_member_map` maps symbol names to member filenames. Unlike `members`, it is always a
+    read-only `collections.abc.Mapping` rather than a `dict`. The index is parsed lazily, the first
+    time the map is accessed, so errors in the index raise `ArchiveReadException` from that first
+    access (ex: a lookup, an `in` test, iteration, `len`, or `repr`) rather than from `load`.
   """
 
   # Describes a member within the library.
@@ -53,49 +210,85 @@ class ArchiveReader:
                                  "content"])
 
   def __init__(self, data = None):
+    # Memory mappings created by `read_file`, which `close` releases.
+    self._mappings = []
     self.reset()
     if data is not None:
       self.load(data)
 
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    """
+      Empties the reader and releases any memory mappings made by `read_file`. Nothing obtained
+      from the reader (member `content` streams, data read from them, `symbol_member_map`) may be
+      used afterwards. If any of them are still referenced, the mapping cannot be released and this
+      raises `BufferError`.
+    """
+    self.reset()
+    while self._mappings:
+      self._mappings[-1].close()
+      self._mappings.pop()
+
   def reset(self):
     self.members = {}
-    self.symbol_member_map = {}
+    self.symbol_member_map = _SymbolMemberMap()
+    # Warnings are counted while loading and reported once loading finishes, rather than printing
+    # the same warning for every member of a malformed library. Maps each warning's format string
+    # to a list of the number of occurrences and the value that the first occurrence was formatted
+    # with.
+    self._warnings = {}
+
+  def _warn(self, warning, value = None):
+    occurrence = self._warnings.get(warning)
+    if occurrence is None:
+      self._warnings[warning] = [1, value]
+    else:
+      occurrence[0] += 1
+
+  def _report_warnings(self):
+    for warning, (count, value) in self._warnings.items():
+      warning = warning.format(value)
+      if count > 1:
+        warning = f"{warning} (first of {count} occurrences)"
+      print(f"Warning: {warning}", file = sys.stderr)
+    self._warnings.clear()
 
   def read_file(self, path):
-    with open(path, "rb") as f:
-      data = f.read()
+    data = _map_file(path)
+    if isinstance(data, mmap.mmap):
+      self._mappings.append(data)
     self.load(data)
 
-  def _read_member(self, data_stream, filename_member = None):
-    filename = data_stream.read_ascii(16).rstrip(" ")
-    if filename not in ("/", "//"):
-      # Parse the filename. It should be in one of two formats: A `/` marks the end of the filename
-      # or the filename instead beings with a `/` and is followed by an ASCII numeric offset into
-      # the filename member that is used to lookup the null terminated filename.
-      if filename.endswith("/"):
-        filename = filename[:-1]
-      elif filename.startswith("/"):
-        filename_offset = int(filename[1:])
-        if filename_member is None:
-          raise ArchiveReadException(
-            f"Member's filename ({filename}) references nonexistent filename lookup member"
-          )
-        filename = filename_member.content.read_cstring(seek = filename_offset)
-      else:
-        raise ArchiveReadException(f"Filename has unexpected format: \"{filename}\"")
-
-      if filename in self.members:
-        raise ArchiveReadException(f"Filename appears in archive twice: \"{filename}\"")
-
-    date = data_stream.read_ascii_integer(12)
-    user_id = data_stream.read_ascii(6).rstrip(" ")
-    group_id = data_stream.read_ascii(6).rstrip(" ")
-    mode = data_stream.read_ascii_integer(8)
-    size = data_stream.read_ascii_integer(10)
-    endHeader = data_stream.read_bytes(2)
-
-    if endHeader[0] != 0x60 or endHeader[1] != 0x0A:
-      print(f"Warning: End of header is {repr(endHeader)} instead of 0x600A", file = sys.stderr)
+  def _read_member(self, data_stream, filename_member = None, header = None):
+    """
+      Reads the member at the cursor of `data_stream`. If the member's header has already been read
+      out of the stream, it should be passed as `header`.
+    """
+    if header is None:
+      header = data_stream.read_struct(_MEMBER_HEADER)
+    filename, date, user_id, group_id, mode, size, endHeader = header
+
+    filename = filename.decode("utf-8").rstrip(" ")
+    filename_format = _classify_filename(filename)
+    # Member names are used as keys in several dictionaries and are the values of
+    # `symbol_member_map`, where the same few names are typically repeated many times.
+    filename = sys.intern(_FILENAME_PARSERS[filename_format](filename, filename_member))
+    if filename_format != _FILENAME_SPECIAL and filename in self.members:
+      raise ArchiveReadException(f"Filename appears in archive twice: \"{filename}\"")
+
+    date = int(date)
+    user_id = user_id.decode("utf-8").rstrip(" ")
+    group_id = group_id.decode("utf-8").rstrip(" ")
+    mode = int(mode)
+    size = int(size)
+
+    if endHeader != b"`\n":
+      self._warn("End of header is {!r} instead of 0x600A", endHeader)
 
     # Per source (2), `ar.h`:
     # Each  archive  file  member begins on an even byte boundary; a newline is inserted between
@@ -105,7 +298,7 @@ class ArchiveReader:
       padding = data_stream.read_bytes(1)
       assert len(padding) == 1
       if padding[0] != ord("\n"):
-        print(f"Warning: Padding is {repr(padding)} instead of a newline char", file = sys.stderr)
+        self._warn("Padding is {!r} instead of a newline char", bytes(padding))
 
     content = data_stream.read_sub_stream(size)
 
@@ -122,13 +315,24 @@ class ArchiveReader:
     return file
 
   def load(self, data):
+    self._warnings.clear()
+    try:
+      self._load(data)
+    finally:
+      # Report warnings even if loading failed, since they may help explain the failure.
+      self._report_warnings()
+
+  def _load(self, data):
     data_stream = parse.BufferStream(data)
 
-    magic = data_stream.read_bytes(8)
+    try:
+      magic, *index_header = data_stream.read_struct(_MAGIC_AND_MEMBER_HEADER)
+    except parse.BufferStreamIndexError:
+      raise ArchiveReadException("Data is too short to be an archive") from None
     if magic != b"!<arch>\n":
       raise ArchiveReadException(f"Bad magic number: {repr(magic)}")
 
-    index_member = self._read_member(data_stream)
+    index_member = self._read_member(data_stream, header = index_header)
     if index_member.name != "/":
       raise ArchiveReadException(f"First member is unexpectedly named {index_member.name}")
 
@@ -136,49 +340,31 @@ class ArchiveReader:
     is_first_member_after_index = True
     member_name_by_offset = {}
     filename_member = None
-    while data_stream.more_to_read():
+    # Libraries can have thousands of members, so avoid repeating these lookups every iteration.
+    more_to_read = data_stream.more_to_read
+    read_member = self._read_member
+    members = self.members
+    while more_to_read():
       file_offset = data_stream.cursor
-      member = self._read_member(data_stream, filename_member)
+      member = read_member(data_stream, filename_member)
+      member_name = member.name
 
       if is_first_member_after_index:
         is_first_member_after_index = False
-        if member.name == "/":
+        if member_name == "/":
           # We don't need this member
           continue
         else:
-          print("Warning: Second index appears to be missing", file = sys.stderr)
-      if member.name == "//":
+          self._warn("Second index appears to be missing")
+      if member_name == "//":
         if filename_member is None:
           filename_member = member
         else:
-          print("Warning: Ignoring unexpected additional filename lookup member",
-                file = sys.stderr)
+          self._warn("Ignoring unexpected additional filename lookup member")
         continue
 
-      member_name_by_offset[file_offset] = member.name
-      self.members[member.name] = member
+      member_name_by_offset[file_offset] = member_name
+      members[member_name] = member
 
-
-    # Step 2: Parse the index.
-
-    # First thing in the index file is the symbol count
-    symbol_count = index_member.content.read_big_endian_dword()
-
-    # Second thing in the index file is the array of member offsets
-    member_offset_stream = index_member.content.read_sub_stream(4 * symbol_count)
-    # Third thing in the index file is the list of the symbol names that the member at the
-    # corresponding offset describes.
-    # Note that the offsets are consecutive `DWORD`s while the symbol names are consecutive C
-    # Strings (i.e. null byte delimited).
-    symbol_name_stream = index_member.content.read_sub_stream()
-
-    while member_offset_stream.more_to_read():
-      member_offset = member_offset_stream.read_big_endian_dword()
-      symbol_name = symbol_name_stream.read_cstring()
-
-      member_name = member_name_by_offset[member_offset]
-      if symbol_name in self.symbol_member_map:
-        raise ArchiveReadException(
-          "Oop, I guess this library needs to support symbols in multiple members"
-        )
-      self.symbol_member_map[symbol_name] = member_name
+    # Step 2: Parse the index. This is deferred until the map is actually used.
+    self.symbol_member_map = _SymbolMemberMap(index_member.content, member_name_by_offset)
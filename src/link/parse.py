@@ -1,8 +1,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
-from . import util
+import struct
 
 # Parsing utilities
 
+_BE_DWORD = struct.Struct(">I")
+
 class BufferStreamIndexError(Exception):
   pass
 
@@ -13,11 +15,82 @@ class BufferStream:
 
     All `read_` methods with a `length` parameter retrieve the rest of the data available if
     `length is None`.
+
+    The `read_` methods are called in tight loops while parsing, so they avoid calling back into
+    other methods of this class where doing so would just be a convenience.
+
+    `data` may be `bytes` or any object that behaves like it, such as an `mmap.mmap` or a
+    `memoryview`. It is stored as a `memoryview` so that sub-streams and the data returned by
+    `read_bytes` share the original buffer rather than copying it. Use `bytes()` on the result if an
+    independent copy is needed.
+
+    Sharing the buffer pins it for as long as the stream, any stream derived from it (via
+    `read_sub_stream` or `clone`), or any `memoryview` returned by `read_bytes` is still referenced.
+    While that is the case, a `bytearray` passed as `data` cannot be resized (doing so raises
+    `BufferError`) and an `mmap.mmap` cannot be closed.
+
+    C String reads search the object that `data` views using its `find` method. That isn't possible
+    if `data` is passed as a `memoryview` of only part of an object (ex: `member.content.data`) or
+    of an object with no `find` method. Such streams still work without copying the whole buffer,
+    but C String reads copy the data being searched out of the view. Prefer `clone` or
+    `read_sub_stream` to creating a new stream from another stream's `data`.
   """
 
+  # A stream is created for every archive member, so keep them small.
+  __slots__ = ("data", "cursor", "_base", "_base_offset")
+
   def __init__(self, data, cursor = 0):
-    self.data = data
+    self.data = memoryview(data)
+    if self.data.format != "B":
+      self.data = self.data.cast("B")
     self.cursor = cursor
+    # `memoryview` can't be searched, so C String lookups use the `find` method of the object
+    # that `data` is a view into, or `None` if that isn't possible. See `_find_null`.
+    # `_base_offset` is the position of `data[0]` within the data passed to the original stream,
+    # which is also its position within `_base`.
+    base = data
+    if isinstance(data, memoryview):
+      # There is no way to tell where a view starts within the object it views unless it covers
+      # the whole thing.
+      base = data.obj
+      if base is None or memoryview(base).nbytes != self.data.nbytes:
+        base = None
+    if not hasattr(base, "find"):
+      base = None
+    self._base = base
+    self._base_offset = 0
+
+  def _derive(self, start, end, cursor = 0):
+    result = BufferStream.__new__(BufferStream)
+    result.data = self.data[start:end]
+    result.cursor = cursor
+    result._base = self._base
+    result._base_offset = self._base_offset + start
+    return result
+
+  def _find_null(self, start, end):
+    """
+      Returns the index of the first null byte in `data[start:end]`, or `-1` if there isn't one.
+    """
+    base = self._base
+    if base is not None:
+      base_offset = self._base_offset
+      result = base.find(b"\x00", base_offset + start, base_offset + end)
+      if result != -1:
+        result -= base_offset
+      return result
+
+    # Copy the view out in chunks to search it. The chunks grow so that short strings don't copy
+    # much of the buffer and long ones don't need many chunks.
+    chunk_size = 256
+    while start < end:
+      chunk_end = min(start + chunk_size, end)
+      result = self.data[start:chunk_end].tobytes().find(b"\x00")
+      if result != -1:
+        return start + result
+      start = chunk_end
+      chunk_size *= 2
+    return -1
 
   def more_to_read(self):
     return self.cursor < len(self.data)
@@ -32,50 +105,109 @@ class BufferStream:
     return self.cursor + length
 
   def read_bytes(self, length = None, seek = None):
-    self.seek(seek)
-    new_cursor = self._new_cursor(length)
-    result = self.data[self.cursor:new_cursor]
-    if length is not None and len(result) != length:
-      raise BufferStreamIndexError(f"Insufficient data in buffer to return {length} bytes")
+    """
+      Returns a `memoryview` into the buffer rather than `bytes`. It pins the buffer in the same way
+      that a stream does (see above). Use `bytes()` on it to get an independent copy.
+    """
+    if seek is not None:
+      self.cursor = seek
+    cursor = self.cursor
+    data = self.data
+    if length is None:
+      new_cursor = len(data)
+    else:
+      new_cursor = cursor + length
+      if new_cursor > len(data):
+        raise BufferStreamIndexError(f"Insufficient data in buffer to return {length} bytes")
     self.cursor = new_cursor
-    return result
+    return data[cursor:new_cursor]
 
   def read_ascii(self, length = None, seek = None):
-    return self.read_bytes(seek = seek, length = length).decode("utf-8")
+    return str(self.read_bytes(length, seek), "utf-8")
 
   def read_ascii_integer(self, length = None, seek = None):
-    return int(self.read_ascii(seek = seek, length = length))
+    # `int` parses ASCII digits (and ignores surrounding whitespace) straight out of a bytes-like
+    # object, so there's no need to decode to a `str` first.
+    return int(self.read_bytes(length, seek))
 
   def read_big_endian_dword(self, seek = None):
-    return util.parse_big_endian(self.read_bytes(seek = seek, length = 4))
+    # This is called once per symbol when parsing an archive index, so it skips the generic
+    # `read_bytes` path and unpacks straight out of the buffer rather than slicing it first.
+    if seek is not None:
+      self.cursor = seek
+    cursor = self.cursor
+    if cursor + 4 > len(self.data):
+      raise BufferStreamIndexError(f"Insufficient data in buffer to return 4 bytes")
+    self.cursor = cursor + 4
+    return _BE_DWORD.unpack_from(self.data, cursor)[0]
+
+  def read_struct(self, struct_format, seek = None):
+    """
+      Unpacks a `struct.Struct` from the buffer without slicing it first. Returns the tuple of
+      unpacked fields.
+    """
+    if seek is not None:
+      self.cursor = seek
+    cursor = self.cursor
+    new_cursor = cursor + struct_format.size
+    if new_cursor > len(self.data):
+      raise BufferStreamIndexError(
+        f"Insufficient data in buffer to return {struct_format.size} bytes"
+      )
+    self.cursor = new_cursor
+    return struct_format.unpack_from(self.data, cursor)
 
   def read_cstring(self, seek = None):
-    self.seek(seek)
+    if seek is not None:
+      self.cursor = seek
+    cursor = self.cursor
+    data = self.data
 
-    if not self.more_to_read():
+    if cursor >= len(data):
       raise BufferStreamIndexError(f"Unable to read from buffer - no more to read")
 
-    string_end_offset = self.cursor
-    while self.data[string_end_offset] != 0:
-      if string_end_offset > len(self.data):
-        raise BufferStreamIndexError(f"End of C String not found within the buffer")
-      string_end_offset += 1
+    string_end_offset = self._find_null(cursor, len(data))
+    if string_end_offset == -1:
+      raise BufferStreamIndexError(f"End of C String not found within the buffer")
 
     # Skip the null byte but do not include it in the returned value
-    new_cursor = string_end_offset + 1
-    result = self.data[self.cursor:string_end_offset].decode("utf-8")
-    self.cursor = new_cursor
-    return result
+    self.cursor = string_end_offset + 1
+    return str(data[cursor:string_end_offset], "utf-8")
+
+  def read_cstrings(self, count, seek = None):
+    """
+      Reads `count` consecutive C Strings, returning them as a list. This is equivalent to calling
+      `read_cstring` `count` times, but splits them all out of the buffer at once.
+    """
+    if seek is not None:
+      self.cursor = seek
+    cursor = self.cursor
+    base = self._base
+
+    # `memoryview` can't be split, so copy the remaining data out of the underlying object (or out
+    # of the view, if we don't have the underlying object).
+    if base is None:
+      remaining = self.data[cursor:].tobytes()
+    else:
+      base_offset = self._base_offset
+      remaining = base[base_offset + cursor:base_offset + len(self.data)]
+    strings = remaining.split(b"\x00", count)
+    # If all `count` strings were terminated, there is an extra trailing element holding whatever
+    # follows the last null byte.
+    if len(strings) <= count:
+      raise BufferStreamIndexError(f"Unable to find {count} C Strings within the buffer")
+    del strings[count]
+
+    # Skip the null bytes but do not include them in the returned values
+    self.cursor = cursor + sum(map(len, strings)) + count
+    return [string.decode("utf-8") for string in strings]
 
   def read_sub_stream(self, length = None, seek = None):
     self.seek(seek)
     new_cursor = self._new_cursor(length)
-    result = BufferStream(self.data[self.cursor:new_cursor])
+    result = self._derive(self.cursor, new_cursor)
     self.cursor = new_cursor
     return result
 
   def clone(self, reset = False):
-    args = [self.data]
-    if not reset:
-      args.append(self.cursor)
-    return BufferStream(*args)
+    return self._derive(0, None, 0 if reset else self.cursor)
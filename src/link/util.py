@@ -1,14 +1,10 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 def parse_big_endian(be_bytes):
-  result = 0
-  for byte in be_bytes:
-    result <<= 8
-    result |= byte
-  return result
+  return int.from_bytes(be_bytes, "big")
 
 def parse_little_endian(le_bytes):
-  return parse_big_endian(reversed(le_bytes))
+  return int.from_bytes(le_bytes, "little")
 
 def wide_string(python_string):
   return python_string.encode("utf-16-le")